@@ -19,36 +19,76 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import sys
+
 import numpy as np
+from scipy.linalg.blas import get_blas_funcs
 
 import lsst.ip.diffim as ipDiffim
 import lsst.afw.display as afwDisplay
 import lsst.afw.image as afwImage
 
-klist = ipDiffim.makeAlardLuptonBasisList(15, 3, [2, 4, 8], [4, 3, 2])
-frame = 1
-for kernel in klist:
-    kImageOut = afwImage.ImageD(kernel.getDimensions())
-    kSum = kernel.computeImage(kImageOut, False)
-    afwDisplay.Display(frame=frame).mtv(kImageOut, title="Kernal Image")
-    frame += 1
 
-kim1 = afwImage.ImageD(klist[0].getDimensions())
-kim2 = afwImage.ImageD(klist[0].getDimensions())
+def computeGramMatrix(arrs, dtype=np.float64):
+    """Return the matrix of inner products of a stack of kernel images.
+
+    Parameters
+    ----------
+    arrs : `numpy.ndarray`
+        Stack of kernel images, of shape (nKernel, height, width).
+    dtype : `numpy.dtype`, optional
+        Precision in which to compute the inner products.  Single precision
+        is adequate for the diagnostic output of this script.
+
+    Returns
+    -------
+    gram : `numpy.ndarray`
+        Inner products of each pair of kernel images; only the upper
+        triangle is filled.
+    """
+    flat = arrs.reshape(len(arrs), -1).astype(dtype, copy=False)
+    # All pairwise inner products in a single symmetric rank-k update; BLAS
+    # blocks the product for cache internally, even for large kernels.
+    # Passing the transposed (Fortran-ordered) view avoids a copy.
+    syrk = get_blas_funcs("syrk", (flat,))
+    gram = syrk(1.0, flat.T, trans=1)
+    return gram
+
+
+def run(args):
+    klist = ipDiffim.makeAlardLuptonBasisList(15, 3, [2, 4, 8], [4, 3, 2])
+
+    # Compute each kernel image exactly once, reusing a single output image,
+    # and cache the pixels
+    nKernel = len(klist)
+    kWidth, kHeight = klist[0].getDimensions()
+    arrs = np.empty((nKernel, kHeight, kWidth))
+    sums = np.empty(nKernel)
+    kImageOut = afwImage.ImageD(klist[0].getDimensions())
+    frame = 1
+    for k1, kernel in enumerate(klist):
+        sums[k1] = kernel.computeImage(kImageOut, False)
+        if args.display:
+            afwDisplay.Display(frame=frame).mtv(kImageOut, title="Kernal Image")
+            frame += 1
+        arrs[k1] = kImageOut.getArray()
+
+    gram = computeGramMatrix(arrs, dtype=np.float32 if args.single else np.float64)
 
-for k1 in range(0, len(klist)):
-    klist[k1].computeImage(kim1, False)
     # Only first term should have sum != 0.0
-    print(k1, np.sum(np.ravel(kim1.getArray())))
+    lines = [f"{k1} {sums[k1]}" for k1 in range(nKernel)]
+    lines.append("")
+    # Not orthonormal tho
+    lines.extend(f"{k1} {k2} {gram[k1, k2]}" for k1 in range(nKernel) for k2 in range(k1, nKernel))
+    sys.stdout.write("\n".join(lines) + "\n")
 
-print()
 
-for k1 in range(0, len(klist)):
-    klist[k1].computeImage(kim1, False)
-    arr1 = kim1.getArray().ravel()
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Display and inspect the Alard-Lupton kernel basis")
+    parser.add_argument("--display", action="store_true", help="Display each kernel image?", default=False)
+    parser.add_argument("--single", action="store_true",
+                        help="Compute the inner products in single precision?", default=False)
 
-    for k2 in range(k1, len(klist)):
-        klist[k2].computeImage(kim2, False)
-        arr2 = kim2.getArray().ravel()
-        # Not orthonormal tho
-        print(k1, k2, np.inner(arr1, arr2))
+    args = parser.parse_args()
+    run(args)
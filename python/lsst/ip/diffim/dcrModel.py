@@ -20,14 +20,29 @@
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import math
+
 import numpy as np
-from scipy import ndimage
+from scipy import fft, ndimage, signal
 from lsst.afw.coord.refraction import differentialRefraction
 import lsst.afw.image as afwImage
 import lsst.geom as geom
 
 __all__ = ["DcrModel", "applyDcr", "calculateDcr", "calculateImageParallacticAngle"]
 
+# Above this ``regularizationWidth`` the binary opening of threshold masks is
+# computed with FFT convolutions, which do not scale with the size of the
+# structuring element.
+_fftOpeningMinWidth = 4
+
+# From this width the smoothing in ``regularizeModelFreq`` uses a recursive
+# Gaussian filter. Its cost does not grow with the width of the filter, but it
+# only approximates the Gaussian, to within ~3% of the peak of the smoothed
+# image, so it is used only where it is clearly faster than the full kernel.
+_recursiveGaussianMinWidth = 16
+
 
 class DcrModel:
     """A model of the true sky after correcting chromatic effects.
@@ -47,12 +62,20 @@ class DcrModel:
     templates for a given ``Exposure``, and provides utilities for conditioning
     the model in ``dcrAssembleCoadd`` to avoid oscillating solutions between
     iterations of forward modeling or between the subfilters of the model.
+
+    The pixels of all subfilters are stored in a single contiguous array,
+    and each entry of ``modelImages`` is a view into it. The input images are
+    copied on construction.
     """
 
     def __init__(self, modelImages, effectiveWavelength, bandwidth, filterInfo=None, psf=None,
                  mask=None, variance=None, photoCalib=None):
         self.dcrNumSubfilters = len(modelImages)
-        self.modelImages = modelImages
+        # Store the subfilter images as one (subfilter, y, x) array, so that
+        # operations across subfilters are single calls over contiguous memory.
+        self._modelStack = np.array([model.array for model in modelImages])
+        self.modelImages = [type(model)(modelArray, deep=False, xy0=model.getXY0())
+                            for model, modelArray in zip(modelImages, self._modelStack)]
         self._filterInfo = filterInfo
         self._effectiveWavelength = effectiveWavelength
         self._bandwidth = bandwidth
@@ -60,6 +83,9 @@ class DcrModel:
         self._mask = mask
         self._variance = variance
         self.photoCalib = photoCalib
+        # Structuring elements of the binary openings used by
+        # ``applyImageThresholds``, keyed by the regularization width.
+        self._filterStructureCache = {}
 
     @classmethod
     def fromImage(cls, maskedImage, dcrNumSubfilters, effectiveWavelength, bandwidth,
@@ -94,21 +120,27 @@ class DcrModel:
         dcrModel : `lsst.pipe.tasks.DcrModel`
             Best fit model of the true sky after correcting chromatic effects.
         """
-        # NANs will potentially contaminate the entire image,
-        # depending on the shift or convolution type used.
         model = maskedImage.image.clone()
         mask = maskedImage.mask.clone()
+        variance = maskedImage.variance.clone()
+        # NANs will potentially contaminate the entire image,
+        # depending on the shift or convolution type used.
+        # Zero them in place and flag them as NO_DATA.
+        badPixels = np.isnan(model.array)
+        np.logical_or(badPixels, np.isnan(variance.array), out=badPixels)
+        np.copyto(model.array, 0., where=badPixels)
+        np.copyto(variance.array, 0., where=badPixels)
+        np.bitwise_or(mask.array, mask.getPlaneBitMask("NO_DATA"), out=mask.array, where=badPixels)
         # We divide the variance by N and not N**2 because we will assume each
         # subfilter is independent. That means that the significance of
         # detected sources will be lower by a factor of sqrt(N) in the
         # subfilter images, but we will recover it when we combine the
         # subfilter images to construct matched templates.
-        variance = maskedImage.variance.clone()
-        variance /= dcrNumSubfilters
-        model /= dcrNumSubfilters
-        modelImages = [model, ]
-        for subfilter in range(1, dcrNumSubfilters):
-            modelImages.append(model.clone())
+        np.divide(variance.array, dcrNumSubfilters, out=variance.array)
+        np.divide(model.array, dcrNumSubfilters, out=model.array)
+        # The DcrModel copies each subfilter into its own plane of a single
+        # stacked array, so there is no need to clone the image here.
+        modelImages = [model]*dcrNumSubfilters
         return cls(modelImages, effectiveWavelength, bandwidth,
                    filterInfo=filterInfo, psf=psf, mask=mask, variance=variance, photoCalib=photoCalib)
 
@@ -266,7 +298,7 @@ class DcrModel:
             raise IndexError("subfilter out of bounds.")
         if maskedImage.getBBox() != self.bbox:
             raise ValueError("The bounding box of a subfilter must not change.")
-        self.modelImages[subfilter] = maskedImage
+        self.modelImages[subfilter].array[:] = maskedImage.array
 
     @property
     def effectiveWavelength(self):
@@ -360,8 +392,35 @@ class DcrModel:
         refImage : `numpy.ndarray`
             The reference image with no chromatic effects applied.
         """
+        # The stack is a view of the model, so no copy of the subfilters is
+        # made before averaging.
+        return np.mean(self._getModelStack(bbox), axis=0)
+
+    def _getModelStack(self, bbox=None):
+        """Return a view of the model images of all subfilters.
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`, optional
+            Sub-region of the coadd. Returns the entire image if `None`.
+
+        Returns
+        -------
+        modelStack : `numpy.ndarray`
+            The model images, stacked along the first axis.
+            Uses numpy axes ordering (subfilter, Y, X).
+
+        Raises
+        ------
+        ValueError
+            If ``bbox`` is not contained in the bounding box of the model.
+        """
         bbox = bbox or self.bbox
-        return np.mean([model[bbox].array for model in self], axis=0)
+        if not self.bbox.contains(bbox):
+            raise ValueError("The bounding box must be contained in the DcrModel.")
+        x0, y0 = self.bbox.getBegin()
+        return self._modelStack[:, bbox.getBeginY() - y0:bbox.getEndY() - y0,
+                                bbox.getBeginX() - x0:bbox.getEndX() - x0]
 
     def assign(self, dcrSubModel, bbox=None):
         """Update a sub-region of the ``DcrModel`` with new values.
@@ -388,7 +447,8 @@ class DcrModel:
 
     def buildMatchedTemplate(self, exposure=None, order=3,
                              visitInfo=None, bbox=None, wcs=None, mask=None,
-                             splitSubfilters=True, splitThreshold=0., amplifyModel=1.):
+                             splitSubfilters=True, splitThreshold=0., amplifyModel=1., useGpu=False,
+                             numThreads=1):
         """Create a DCR-matched template image for an exposure.
 
         Parameters
@@ -416,6 +476,11 @@ class DcrModel:
         amplifyModel : `float`, optional
             Multiplication factor to amplify differences between model planes.
             Used to speed convergence of iterative forward modeling.
+        useGpu : `bool`, optional
+            Shift and sum the subfilter images on a GPU. Requires ``cupy``.
+        numThreads : `int`, optional
+            Number of threads to use to shift the subfilter images.
+            Default: 1
 
         Returns
         -------
@@ -440,14 +505,33 @@ class DcrModel:
         dcrShift = calculateDcr(visitInfo, wcs, self.effectiveWavelength, self.bandwidth, len(self),
                                 splitSubfilters=splitSubfilters)
         templateImage = afwImage.ImageF(bbox)
-        refModel = self.getReferenceImage(bbox)
-        for subfilter, dcr in enumerate(dcrShift):
-            if amplifyModel > 1:
-                model = (self[subfilter][bbox].array - refModel)*amplifyModel + refModel
-            else:
-                model = self[subfilter][bbox].array
-            templateImage.array += applyDcr(model, dcr, splitSubfilters=splitSubfilters,
-                                            splitThreshold=splitThreshold, order=order)
+        modelStack = self._getModelStack(bbox)
+        if useGpu:
+            templateImage.array[:] = _buildTemplateArrayGpu(modelStack, dcrShift, order=order,
+                                                            splitSubfilters=splitSubfilters,
+                                                            splitThreshold=splitThreshold,
+                                                            amplifyModel=amplifyModel)
+            return templateImage
+        templateArray = templateImage.array
+        if amplifyModel > 1:
+            # Amplify all subfilters at once, rather than inside the loop.
+            refModel = np.mean(modelStack, axis=0)
+            modelStack = (modelStack - refModel)*amplifyModel + refModel
+        # Everything but the model and shift is the same for every subfilter.
+        # The template is single precision, so compute it in single precision
+        # to halve the memory traffic of the shifts.
+        shiftModel = functools.partial(applyDcr, splitSubfilters=splitSubfilters,
+                                       splitThreshold=splitThreshold, order=order,
+                                       dtype=templateArray.dtype)
+        if numThreads > 1:
+            # The subfilters are shifted independently, but are summed in order
+            # below so that the template does not depend on ``numThreads``.
+            with ThreadPoolExecutor(max_workers=numThreads) as executor:
+                shiftedModels = list(executor.map(shiftModel, modelStack, dcrShift))
+        else:
+            shiftedModels = map(shiftModel, modelStack, dcrShift)
+        for shiftedModel in shiftedModels:
+            templateArray += shiftedModel
         return templateImage
 
     def buildMatchedExposure(self, exposure=None,
@@ -515,11 +599,13 @@ class DcrModel:
             Relative weight to give the new solution when updating the model.
             Defaults to 1.0, which gives equal weight to both solutions.
         """
-        # Calculate weighted averages of the images.
+        # Calculate weighted averages of the images, operating directly on
+        # the pixel arrays to avoid allocating temporaries.
         for model, newModel in zip(self, modelImages):
-            newModel *= gain
-            newModel += model[bbox]
-            newModel /= 1. + gain
+            newArray = newModel.array
+            np.multiply(newArray, gain, out=newArray)
+            np.add(newArray, model[bbox].array, out=newArray)
+            np.divide(newArray, 1. + gain, out=newArray)
 
     def regularizeModelIter(self, subfilter, newModel, bbox, regularizationFactor,
                             regularizationWidth=2):
@@ -591,7 +677,7 @@ class DcrModel:
         # The noise should be lower in the smoothed image by
         # sqrt(Nsmooth) ~ fwhm pixels
         noiseLevel /= fwhm
-        smoothRef = ndimage.filters.gaussian_filter(referenceImage, filterWidth, mode='constant')
+        smoothRef = _smoothImage(referenceImage, filterWidth)
         # Add a three sigma offset to both the reference and model to prevent
         # dividing by zero. Note that this will also slightly suppress faint
         # variations in color.
@@ -599,19 +685,28 @@ class DcrModel:
 
         lowThreshold = smoothRef/maxDiff
         highThreshold = smoothRef*maxDiff
-        for model in modelImages:
-            self.applyImageThresholds(model.array,
-                                      highThreshold=highThreshold,
-                                      lowThreshold=lowThreshold,
-                                      regularizationWidth=regularizationWidth)
-            smoothModel = ndimage.filters.gaussian_filter(model.array, filterWidth, mode='constant')
-            smoothModel += 3.*noiseLevel
-            relativeModel = smoothModel/smoothRef
-            # Now sharpen the smoothed relativeModel using an alpha of 3.
-            alpha = 3.
-            relativeModel2 = ndimage.filters.gaussian_filter(relativeModel, filterWidth/alpha)
-            relativeModel += alpha*(relativeModel - relativeModel2)
-            model.array = relativeModel*referenceImage
+        # Stack the subfilter images so that they can be smoothed together,
+        # without smoothing along the subfilter axis.
+        modelStack = np.array([model.array for model in modelImages])
+        self.applyImageThresholds(modelStack,
+                                  highThreshold=highThreshold,
+                                  lowThreshold=lowThreshold,
+                                  regularizationWidth=regularizationWidth)
+        smoothModels = _smoothImage(modelStack, filterWidth)
+        # The arithmetic below is done in place on the stacked arrays, to
+        # avoid allocating a new full-size temporary for each step.
+        smoothModels += 3.*noiseLevel
+        relativeModels = np.divide(smoothModels, smoothRef, out=smoothModels)
+        # Now sharpen the smoothed relativeModels using an alpha of 3.
+        alpha = 3.
+        relativeModels2 = ndimage.filters.gaussian_filter(relativeModels,
+                                                          (0, filterWidth/alpha, filterWidth/alpha))
+        sharpening = np.subtract(relativeModels, relativeModels2, out=relativeModels2)
+        sharpening *= alpha
+        relativeModels += sharpening
+        relativeModels *= referenceImage
+        for model, relativeModel in zip(modelImages, relativeModels):
+            model.array = relativeModel
 
     def calculateNoiseCutoff(self, image, statsCtrl, bufferSize,
                              convergenceMaskPlanes="DETECTED", mask=None, bbox=None):
@@ -647,7 +742,7 @@ class DcrModel:
         convergeMask = mask.getPlaneBitMask(convergenceMaskPlanes)
 
         backgroundPixels = mask[bboxShrink].array & (statsCtrl.getAndMask() | convergeMask) == 0
-        noiseCutoff = np.std(image[bboxShrink].array[backgroundPixels])
+        noiseCutoff = np.std(image[bboxShrink].array[backgroundPixels], dtype=np.float64)
         return noiseCutoff
 
     def applyImageThresholds(self, image, highThreshold=None, lowThreshold=None, regularizationWidth=2):
@@ -665,36 +760,160 @@ class DcrModel:
         Parameters
         ----------
         image : `numpy.ndarray`
-            The image to apply the thresholds to.
-            The values will be modified in place.
+            The image to apply the thresholds to, or a stack of images along
+            the first axis. The values will be modified in place.
         highThreshold : `numpy.ndarray`, optional
             Array of upper limit values for each pixel of ``image``.
+            Must be broadcastable to the shape of ``image``.
         lowThreshold : `numpy.ndarray`, optional
             Array of lower limit values for each pixel of ``image``.
+            Must be broadcastable to the shape of ``image``.
         regularizationWidth : `int`, optional
             Minimum radius of a region to include in regularization, in pixels.
         """
-        # Generate the structure for binary erosion and dilation, which is used
-        # to remove noise-like pixels. Groups of pixels with a radius smaller
-        # than ``regularizationWidth`` will be excluded from regularization.
-        filterStructure = ndimage.iterate_structure(ndimage.generate_binary_structure(2, 1),
-                                                    regularizationWidth)
+        if regularizationWidth > 0:
+            binaryOpening = self._getBinaryOpening(image.shape, regularizationWidth)
+        # Reuse one boolean buffer for both comparisons, and write the
+        # thresholds in place rather than through fancy indexing, to avoid
+        # allocating full-image temporaries.
+        flaggedPixels = np.empty(image.shape, dtype=bool)
         if highThreshold is not None:
-            highPixels = image > highThreshold
+            highPixels = np.greater(image, highThreshold, out=flaggedPixels)
             if regularizationWidth > 0:
                 # Erode and dilate ``highPixels`` to exclude noisy pixels.
-                highPixels = ndimage.morphology.binary_opening(highPixels, structure=filterStructure)
-            image[highPixels] = highThreshold[highPixels]
+                highPixels = binaryOpening(highPixels)
+            np.copyto(image, highThreshold, where=highPixels)
         if lowThreshold is not None:
-            lowPixels = image < lowThreshold
+            lowPixels = np.less(image, lowThreshold, out=flaggedPixels)
             if regularizationWidth > 0:
                 # Erode and dilate ``lowPixels`` to exclude noisy pixels.
-                lowPixels = ndimage.morphology.binary_opening(lowPixels, structure=filterStructure)
-            image[lowPixels] = lowThreshold[lowPixels]
+                lowPixels = binaryOpening(lowPixels)
+            np.copyto(image, lowThreshold, where=lowPixels)
+
+    def _getBinaryOpening(self, shape, regularizationWidth):
+        """Return a binary opening for removing noise-like pixels.
+
+        Parameters
+        ----------
+        shape : `tuple` of `int`
+            Shape of the boolean arrays that will be opened. Any axes before
+            the last two are treated as a stack of independent images.
+        regularizationWidth : `int`
+            Minimum radius of a region to include in regularization, in pixels.
+
+        Returns
+        -------
+        binaryOpening : callable
+            Function taking a boolean `numpy.ndarray` and returning its
+            binary opening.
+        """
+        if regularizationWidth not in self._filterStructureCache:
+            # Generate the structure for binary erosion and dilation, which is
+            # used to remove noise-like pixels. Groups of pixels with a radius
+            # smaller than ``regularizationWidth`` will be excluded from
+            # regularization.
+            self._filterStructureCache[regularizationWidth] = \
+                ndimage.iterate_structure(ndimage.generate_binary_structure(2, 1), regularizationWidth)
+        filterStructure = self._filterStructureCache[regularizationWidth]
+        if regularizationWidth > _fftOpeningMinWidth:
+            return _makeFftBinaryOpening(shape[-2:], filterStructure)
+        # Do not erode or dilate along the stacking axes, if any.
+        filterStructure = filterStructure.reshape((1,)*(len(shape) - 2) + filterStructure.shape)
+        return functools.partial(ndimage.morphology.binary_opening, structure=filterStructure)
+
+
+def _smoothImage(image, sigma):
+    """Smooth an image, or a stack of images, with a Gaussian filter.
+
+    Pixels outside the image are treated as zero. Wide filters use a recursive
+    approximation of the Gaussian, which is much faster than convolving with
+    the full kernel, unless the image contains non-finite pixels.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        The image to smooth. Only the last two axes are smoothed.
+    sigma : `float`
+        Standard deviation of the Gaussian, in pixels.
+
+    Returns
+    -------
+    smoothedImage : `numpy.ndarray`
+        The smoothed image, with the same type as ``image``.
+    """
+    # The recursive filter would spread a non-finite pixel along its whole row
+    # and column, and from there over the image, rather than over the ~4 sigma
+    # neighbourhood of the full kernel.
+    if sigma < _recursiveGaussianMinWidth or not np.isfinite(image).all():
+        sigmas = (0,)*(image.ndim - 2) + (sigma, sigma)
+        return ndimage.filters.gaussian_filter(image, sigmas, mode='constant')
+    # Recursive coefficients from Young & van Vliet (1995), Signal Processing,
+    # 44, 139. The filter is run forward and backward along each axis.
+    q = 0.98711*sigma - 0.96330
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+    numerator = [1. - (b1 + b2 + b3)/b0]
+    denominator = [1., -b1/b0, -b2/b0, -b3/b0]
+    # The forward pass starts from zero state, which is exact for zero pixels
+    # beyond the leading edges. The backward pass also starts from zero state,
+    # so the forward response must be allowed to decay past the trailing
+    # edges first: pad them with zeros and crop the result.
+    pad = int(np.ceil(4*sigma))
+    smoothedImage = np.pad(image, [(0, 0)]*(image.ndim - 2) + [(0, pad), (0, pad)])
+    for axis in (-1, -2):
+        smoothedImage = signal.lfilter(numerator, denominator, smoothedImage, axis=axis)
+        smoothedImage = np.flip(signal.lfilter(numerator, denominator, np.flip(smoothedImage, axis),
+                                               axis=axis), axis)
+    return smoothedImage[..., :image.shape[-2], :image.shape[-1]].astype(image.dtype)
+
+
+def _makeFftBinaryOpening(shape, structure):
+    """Construct a binary opening for arrays of a fixed shape that uses FFT
+    convolutions for the erosion and dilation.
+
+    The cost of the opening is independent of the size of the structuring
+    element, which makes it much faster than
+    `scipy.ndimage.binary_opening` for large structures. The spectrum of the
+    structuring element is computed once and reused for every call.
+
+    Parameters
+    ----------
+    shape : `tuple` of `int`
+        Shape of the images that will be opened.
+    structure : `numpy.ndarray`
+        Symmetric two dimensional structuring element of the opening.
+
+    Returns
+    -------
+    binaryOpening : callable
+        Function taking a boolean `numpy.ndarray` whose last two axes have
+        shape ``shape`` and returning its binary opening. Any leading axes are
+        treated as a stack of independent images. Pixels outside the images
+        are treated as unset, as in `scipy.ndimage.binary_opening`.
+    """
+    structure = np.asarray(structure, dtype=bool)
+    axes = (-2, -1)
+    fftShape = [fft.next_fast_len(n + s - 1, real=True) for n, s in zip(shape, structure.shape)]
+    structureSpectrum = fft.rfftn(structure.astype(np.float64), fftShape)
+    slices = (Ellipsis,) + tuple(slice((s - 1)//2, (s - 1)//2 + n) for n, s in zip(shape, structure.shape))
+    # Erosion keeps pixels where the full structure overlaps set pixels.
+    # Thresholds are offset by 0.5 to be robust to round-off in the FFTs.
+    erosionThreshold = np.sum(structure) - 0.5
+
+    def convolve(pixels):
+        spectrum = fft.rfftn(pixels.astype(np.float64), fftShape, axes=axes)
+        return fft.irfftn(spectrum*structureSpectrum, fftShape, axes=axes)[slices]
+
+    def binaryOpening(pixels):
+        eroded = convolve(pixels) > erosionThreshold
+        return convolve(eroded) > 0.5
+    return binaryOpening
 
 
 def applyDcr(image, dcr, useInverse=False, splitSubfilters=False, splitThreshold=0.,
-             doPrefilter=True, order=3):
+             doPrefilter=True, order=3, dtype=None):
     """Shift an image along the X and Y directions.
 
     Parameters
@@ -724,39 +943,123 @@ def applyDcr(image, dcr, useInverse=False, splitSubfilters=False, splitThreshold
         precalculate the filter.
     order : `int`, optional
         The order of the spline interpolation, default is 3.
+    dtype : `numpy.dtype`, optional
+        Data type of the spline coefficients and of the shifted image.
+        Defaults to double precision for the spline coefficients, and the
+        type of the coefficients for the shifted image.
 
     Returns
     -------
     shiftedImage : `numpy.ndarray`
         A copy of the input image with the specified shift applied.
     """
-    if doPrefilter:
-        prefilteredImage = ndimage.spline_filter(image, order=order)
+    # The translation is performed by `scipy.ndimage.shift`, which applies the
+    # spline interpolation separably along each axis. Spline filtering is
+    # only needed for orders above 1, and would otherwise just copy the image.
+    if doPrefilter and order > 1:
+        prefilteredImage = ndimage.spline_filter(image, order=order, output=dtype or np.float64)
     else:
         prefilteredImage = image
+    shifts = _getDcrShifts(dcr, useInverse=useInverse, splitSubfilters=splitSubfilters,
+                           splitThreshold=splitThreshold)
+    shiftedImage = ndimage.shift(prefilteredImage, shifts[0], output=dtype, prefilter=False, order=order)
+    if len(shifts) > 1:
+        for shift in shifts[1:]:
+            shiftedImage += ndimage.shift(prefilteredImage, shift, output=dtype, prefilter=False, order=order)
+        shiftedImage /= len(shifts)
+    return shiftedImage
+
+
+def _getDcrShifts(dcr, useInverse=False, splitSubfilters=False, splitThreshold=0.):
+    """Select the shifts to apply to an image and average for one subfilter.
+
+    Parameters
+    ----------
+    dcr : `tuple`
+        Shift calculated with ``calculateDcr``.
+        Uses numpy axes ordering (Y, X).
+    useInverse : `bool`, optional
+        Apply the shift in the opposite direction. Default: False
+    splitSubfilters : `bool`, optional
+        Calculate DCR for two evenly-spaced wavelengths in each subfilter,
+        instead of at the midpoint. Default: False
+    splitThreshold : `float`, optional
+        Minimum DCR difference within a subfilter required to use
+        ``splitSubfilters``
+
+    Returns
+    -------
+    shifts : `list` of `tuple` of two `float`
+        The shifts to apply, in pixels, using numpy axes ordering (Y, X).
+        The shifted images should be averaged.
+    """
     if splitSubfilters:
         shiftAmp = np.max(np.abs([_dcr0 - _dcr1 for _dcr0, _dcr1 in zip(dcr[0], dcr[1])]))
         if shiftAmp >= splitThreshold:
-            if useInverse:
-                shift = [-1.*s for s in dcr[0]]
-                shift1 = [-1.*s for s in dcr[1]]
-            else:
-                shift = dcr[0]
-                shift1 = dcr[1]
-            shiftedImage = ndimage.shift(prefilteredImage, shift, prefilter=False, order=order)
-            shiftedImage += ndimage.shift(prefilteredImage, shift1, prefilter=False, order=order)
-            shiftedImage /= 2.
-            return shiftedImage
+            shifts = [dcr[0], dcr[1]]
         else:
             # If the difference in the DCR shifts is less than the threshold,
             # then just use the average shift for efficiency.
-            dcr = (np.mean(dcr[0]), np.mean(dcr[1]))
-    if useInverse:
-        shift = [-1.*s for s in dcr]
+            # This requires a single shift of the image, instead of two.
+            shifts = [tuple(np.mean(dcr, axis=0))]
     else:
-        shift = dcr
-    shiftedImage = ndimage.shift(prefilteredImage, shift, prefilter=False, order=order)
-    return shiftedImage
+        shifts = [dcr]
+    if useInverse:
+        shifts = [tuple(-1.*s for s in shift) for shift in shifts]
+    return shifts
+
+
+def _buildTemplateArrayGpu(modelStack, dcrShift, order=3, splitSubfilters=True, splitThreshold=0.,
+                           amplifyModel=1.):
+    """Shift and sum the subfilter images of a DCR model on a GPU.
+
+    The model is copied to the GPU once, and only the summed template is
+    copied back.
+
+    Parameters
+    ----------
+    modelStack : `numpy.ndarray`
+        The model images, stacked along the first axis.
+    dcrShift : `list`
+        Shifts calculated with ``calculateDcr`` for each subfilter.
+    order : `int`, optional
+        Interpolation order of the DCR shift.
+    splitSubfilters : `bool`, optional
+        Calculate DCR for two evenly-spaced wavelengths in each subfilter,
+        instead of at the midpoint.
+    splitThreshold : `float`, optional
+        Minimum DCR difference within a subfilter required to use
+        ``splitSubfilters``
+    amplifyModel : `float`, optional
+        Multiplication factor to amplify differences between model planes.
+
+    Returns
+    -------
+    templateArray : `numpy.ndarray`
+        The DCR-matched template.
+
+    Raises
+    ------
+    ImportError
+        If ``cupy`` is not available.
+    """
+    try:
+        import cupy
+        from cupyx.scipy import ndimage as cupyNdimage
+    except ImportError as err:
+        raise ImportError("cupy is required to build DCR-matched templates on a GPU.") from err
+    models = cupy.asarray(modelStack)
+    if amplifyModel > 1:
+        refModel = cupy.mean(models, axis=0)
+        models = (models - refModel)*amplifyModel + refModel
+    templateArray = cupy.zeros(models.shape[1:], dtype=models.dtype)
+    for model, dcr in zip(models, dcrShift):
+        if order > 1:
+            model = cupyNdimage.spline_filter(model, order=order, output=models.dtype)
+        shifts = _getDcrShifts(dcr, splitSubfilters=splitSubfilters, splitThreshold=splitThreshold)
+        for shift in shifts:
+            templateArray += cupyNdimage.shift(model, shift, prefilter=False, order=order)/len(shifts)
+    return cupy.asnumpy(templateArray)
 
 
 def calculateDcr(visitInfo, wcs, effectiveWavelength, bandwidth, dcrNumSubfilters, splitSubfilters=False):
@@ -784,34 +1087,39 @@ def calculateDcr(visitInfo, wcs, effectiveWavelength, bandwidth, dcrNumSubfilter
         The 2D shift due to DCR, in pixels.
         Uses numpy axes ordering (Y, X).
     """
-    rotation = calculateImageParallacticAngle(visitInfo, wcs)
-    dcrShift = []
-    weight = [0.75, 0.25]
-    for wl0, wl1 in wavelengthGenerator(effectiveWavelength, bandwidth, dcrNumSubfilters):
-        # Note that diffRefractAmp can be negative, since it's relative to the
-        # midpoint of the full band
-        diffRefractAmp0 = differentialRefraction(wavelength=wl0, wavelengthRef=effectiveWavelength,
-                                                 elevation=visitInfo.getBoresightAzAlt().getLatitude(),
-                                                 observatory=visitInfo.getObservatory(),
-                                                 weather=visitInfo.getWeather())
-        diffRefractAmp1 = differentialRefraction(wavelength=wl1, wavelengthRef=effectiveWavelength,
-                                                 elevation=visitInfo.getBoresightAzAlt().getLatitude(),
-                                                 observatory=visitInfo.getObservatory(),
-                                                 weather=visitInfo.getWeather())
-        if splitSubfilters:
-            diffRefractPix0 = diffRefractAmp0.asArcseconds()/wcs.getPixelScale().asArcseconds()
-            diffRefractPix1 = diffRefractAmp1.asArcseconds()/wcs.getPixelScale().asArcseconds()
-            diffRefractArr = [diffRefractPix0*weight[0] + diffRefractPix1*weight[1],
-                              diffRefractPix0*weight[1] + diffRefractPix1*weight[0]]
-            shiftX = [diffRefractPix*np.sin(rotation.asRadians()) for diffRefractPix in diffRefractArr]
-            shiftY = [diffRefractPix*np.cos(rotation.asRadians()) for diffRefractPix in diffRefractArr]
-            dcrShift.append(((shiftY[0], shiftX[0]), (shiftY[1], shiftX[1])))
-        else:
-            diffRefractAmp = (diffRefractAmp0 + diffRefractAmp1)/2.
-            diffRefractPix = diffRefractAmp.asArcseconds()/wcs.getPixelScale().asArcseconds()
-            shiftX = diffRefractPix*np.sin(rotation.asRadians())
-            shiftY = diffRefractPix*np.cos(rotation.asRadians())
-            dcrShift.append((shiftY, shiftX))
+    rotation = calculateImageParallacticAngle(visitInfo, wcs).asRadians()
+    sinRotation = np.sin(rotation)
+    cosRotation = np.cos(rotation)
+    pixelScale = wcs.getPixelScale().asArcseconds()
+    elevation = visitInfo.getBoresightAzAlt().getLatitude()
+    observatory = visitInfo.getObservatory()
+    weather = visitInfo.getWeather()
+    # Adjacent subfilters share their wavelength endpoints, so only calculate
+    # the refraction once at each of the ``dcrNumSubfilters + 1`` edges.
+    edges = wavelengthEdges(effectiveWavelength, bandwidth, dcrNumSubfilters)
+    wavelengths = np.append(edges[:, 0], edges[-1, 1])
+    # Note that diffRefractAmp can be negative, since it's relative to the
+    # midpoint of the full band
+    diffRefractAmp = np.array([differentialRefraction(wavelength=wl, wavelengthRef=effectiveWavelength,
+                                                      elevation=elevation,
+                                                      observatory=observatory,
+                                                      weather=weather).asArcseconds()
+                               for wl in wavelengths])
+    diffRefractPix = diffRefractAmp/pixelScale
+    diffRefractPix0 = diffRefractPix[:-1]
+    diffRefractPix1 = diffRefractPix[1:]
+    if splitSubfilters:
+        weight = [0.75, 0.25]
+        diffRefractArr = [diffRefractPix0*weight[0] + diffRefractPix1*weight[1],
+                          diffRefractPix0*weight[1] + diffRefractPix1*weight[0]]
+        shiftX = [diffRefractPix*sinRotation for diffRefractPix in diffRefractArr]
+        shiftY = [diffRefractPix*cosRotation for diffRefractPix in diffRefractArr]
+        dcrShift = list(zip(zip(shiftY[0], shiftX[0]), zip(shiftY[1], shiftX[1])))
+    else:
+        diffRefractPix = (diffRefractPix0 + diffRefractPix1)/2.
+        shiftX = diffRefractPix*sinRotation
+        shiftY = diffRefractPix*cosRotation
+        dcrShift = list(zip(shiftY, shiftX))
     return dcrShift
 
 
@@ -837,16 +1145,40 @@ def calculateImageParallacticAngle(visitInfo, wcs):
         North along the +x axis and East along the -y axis.
     """
     parAngle = visitInfo.getBoresightParAngle().asRadians()
-    cd = wcs.getCdMatrix()
+    (cd00, cd01), (cd10, cd11) = wcs.getCdMatrix().tolist()
     if wcs.isFlipped:
-        cdAngle = (np.arctan2(-cd[0, 1], cd[0, 0]) + np.arctan2(cd[1, 0], cd[1, 1]))/2.
+        cdAngle = (math.atan2(-cd01, cd00) + math.atan2(cd10, cd11))/2.
         rotAngle = (cdAngle + parAngle)*geom.radians
     else:
-        cdAngle = (np.arctan2(cd[0, 1], -cd[0, 0]) + np.arctan2(cd[1, 0], cd[1, 1]))/2.
+        cdAngle = (math.atan2(cd01, -cd00) + math.atan2(cd10, cd11))/2.
         rotAngle = (cdAngle - parAngle)*geom.radians
     return rotAngle
 
 
+def wavelengthEdges(effectiveWavelength, bandwidth, dcrNumSubfilters):
+    """Calculate the wavelength endpoints of all subfilters.
+
+    Parameters
+    ----------
+    effectiveWavelength : `float`
+        The effective wavelength of the current filter, in nanometers.
+    bandwidth : `float`
+        The bandwidth of the current filter, in nanometers.
+    dcrNumSubfilters : `int`
+        Number of sub-filters used to model chromatic effects within a band.
+
+    Returns
+    -------
+    edges : `numpy.ndarray`, (``dcrNumSubfilters``, 2)
+        The lower and upper wavelength of each subfilter, in nanometers.
+        Adjacent subfilters share an endpoint.
+    """
+    lambdaMin = effectiveWavelength - bandwidth/2
+    lambdaMax = effectiveWavelength + bandwidth/2
+    edges = np.linspace(lambdaMin, lambdaMax, dcrNumSubfilters + 1)
+    return np.stack([edges[:-1], edges[1:]], axis=1)
+
+
 def wavelengthGenerator(effectiveWavelength, bandwidth, dcrNumSubfilters):
     """Iterate over the wavelength endpoints of subfilters.
 
@@ -863,9 +1195,10 @@ def wavelengthGenerator(effectiveWavelength, bandwidth, dcrNumSubfilters):
     ------
     `tuple` of two `float`
         The next set of wavelength endpoints for a subfilter, in nanometers.
+
+    See Also
+    --------
+    wavelengthEdges
     """
-    lambdaMin = effectiveWavelength - bandwidth/2
-    lambdaMax = effectiveWavelength + bandwidth/2
-    wlStep = bandwidth/dcrNumSubfilters
-    for wl in np.linspace(lambdaMin, lambdaMax, dcrNumSubfilters, endpoint=False):
-        yield (wl, wl + wlStep)
+    for wl0, wl1 in wavelengthEdges(effectiveWavelength, bandwidth, dcrNumSubfilters).tolist():
+        yield (wl0, wl1)
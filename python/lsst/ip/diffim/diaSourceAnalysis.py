@@ -31,6 +31,11 @@ import lsst.pex.config as pexConfig
 
 scaling = 5
 
+# Footprints up to this many pixels are copied into contiguous arrays before
+# they are analyzed; the copy is cheap for small cutouts and speeds up every
+# following pass, but costs more than it saves for large ones.
+_contiguousMaxPixels = 128*128
+
 
 class DiaSourceAnalystConfig(pexConfig.Config):
     srcBadMaskPlanes = pexConfig.ListField(
@@ -77,83 +82,186 @@ class DiaSourceAnalyst(object):
         srcBadMaskPlanes = self.config.srcBadMaskPlanes
         for maskPlane in srcBadMaskPlanes:
             self.bitMask |= afwImage.Mask.getPlaneBitMask(maskPlane)
+        self._detBit = afwImage.Mask.getPlaneBitMask("DETECTED")
+        self._detNegBit = afwImage.Mask.getPlaneBitMask("DETECTED_NEGATIVE")
+
+        self._fBadPixels = self.config.fBadPixels
+        self._fluxPolarityRatio = self.config.fluxPolarityRatio
+        self._nPolarityRatio = self.config.nPolarityRatio
+        self._nMaskedRatio = self.config.nMaskedRatio
+        self._nGoodRatio = self.config.nGoodRatio
 
     def countDetected(self, mask):
-        idxP = num.where(mask & afwImage.Mask.getPlaneBitMask("DETECTED"))
-        idxN = num.where(mask & afwImage.Mask.getPlaneBitMask("DETECTED_NEGATIVE"))
-        return len(idxP[0]), len(idxN[0])
+        return num.count_nonzero(mask & self._detBit), num.count_nonzero(mask & self._detNegBit)
 
     def countMasked(self, mask):
-        idxM = num.where(mask & self.bitMask)
-        return len(idxM[0])
+        return num.count_nonzero(mask & self.bitMask)
 
     def countPolarity(self, mask, pixels):
         unmasked = ((mask & self.bitMask) == 0)
-        idxP = num.where((pixels >= 0) & unmasked)
-        idxN = num.where((pixels < 0) & unmasked)
-        fluxP = num.sum(pixels[idxP])
-        fluxN = num.sum(pixels[idxN])
-        return len(idxP[0]), len(idxN[0]), fluxP, fluxN
+        posMask = (pixels >= 0) & unmasked
+        negMask = (pixels < 0) & unmasked
+        fluxP = num.add.reduce(pixels, axis=None, where=posMask, initial=0.0)
+        fluxN = num.add.reduce(pixels, axis=None, where=negMask, initial=0.0)
+        return num.count_nonzero(posMask), num.count_nonzero(negMask), fluxP, fluxN
+
+    def _analyze(self, pixels, unmasked):
+        """Gather the polarity statistics used by `testSource` in a single
+        traversal of the footprint.
+
+        Parameters
+        ----------
+        pixels : `numpy.ndarray`
+            Image array of the footprint.
+        unmasked : `numpy.ndarray` of `bool`
+            Pixels with none of ``srcBadMaskPlanes`` set.
+
+        Returns
+        -------
+        nPos, nNeg : `int`
+            Number of unmasked non-negative and negative pixels.
+        fPos, fNeg : `float`
+            Summed flux of the unmasked non-negative and negative pixels.
+        """
+        pos = unmasked & (pixels >= 0)
+        neg = unmasked & (pixels < 0)
+        nPos = num.count_nonzero(pos)
+        nNeg = num.count_nonzero(neg)
+        fPos = num.add.reduce(pixels, axis=None, where=pos, initial=0.0)
+        fNeg = num.add.reduce(pixels, axis=None, where=neg, initial=0.0)
+        return nPos, nNeg, fPos, fNeg
 
     def testSource(self, source, subMi):
         imArr, maArr, varArr = subMi.getArrays()
+        if maArr.size <= _contiguousMaxPixels:
+            imArr = num.ascontiguousarray(imArr)
+            maArr = num.ascontiguousarray(maArr)
         flux = source.getApFlux()
+        debug = self.log.isDebugEnabled()
 
-        nPixels = subMi.getWidth() * subMi.getHeight()
-        nPos, nNeg, fPos, fNeg = self.countPolarity(maArr, imArr)
-        nDetPos, nDetNeg = self.countDetected(maArr)
-        nMasked = self.countMasked(maArr)
-        assert(nPixels == (nMasked + nPos + nNeg))
+        nPixels = maArr.size
+        unmasked = (maArr & self.bitMask) == 0
+        nMasked = nPixels - num.count_nonzero(unmasked)
 
-        # 1) Too many pixels in the detection are masked
+        # 1) Too many pixels in the detection are masked; checked before
+        # the polarity statistics are gathered so that rejection is cheap
         fMasked = (nMasked / nPixels)
-        fMaskedTol = self.config.fBadPixels
+        fMaskedTol = self._fBadPixels
         if fMasked > fMaskedTol:
-            self.log.debug("Candidate %d : BAD fBadPixels %.2f > %.2f", source.getId(), fMasked, fMaskedTol)
+            if debug:
+                self.log.debug("Candidate %d : BAD fBadPixels %.2f > %.2f",
+                               source.getId(), fMasked, fMaskedTol)
             return False
 
+        nPos, nNeg, fPos, fNeg = self._analyze(imArr, unmasked)
+
+        # Select the correct-polarity ("good") pixels for the source
         if flux > 0:
-            # positive-going source
-            fluxRatio = fPos / (fPos + abs(fNeg))
-            ngoodRatio = nPos / nPixels
-            maskRatio = nPos / (nPos + nMasked)
-            npolRatio = nPos / (nPos + nNeg)
+            nGood, nOpp, fGood = nPos, nNeg, fPos
         else:
-            # negative-going source
-            fluxRatio = abs(fNeg) / (fPos + abs(fNeg))
-            ngoodRatio = nNeg / nPixels
-            maskRatio = nNeg / (nNeg + nMasked)
-            npolRatio = nNeg / (nNeg + nPos)
+            nGood, nOpp, fGood = nNeg, nPos, abs(fNeg)
+        fluxRatio = fGood / (fPos + abs(fNeg))
+        ngoodRatio = nGood / nPixels
+        maskRatio = nGood / (nGood + nMasked)
+        npolRatio = nGood / (nGood + nOpp)
 
         # 2) Not enough flux in unmasked correct-polarity pixels
-        fluxRatioTolerance = self.config.fluxPolarityRatio
+        fluxRatioTolerance = self._fluxPolarityRatio
         if fluxRatio < fluxRatioTolerance:
-            self.log.debug("Candidate %d : BAD flux polarity %.2f < %.2f (pos=%.2f neg=%.2f)",
-                           source.getId(), fluxRatio, fluxRatioTolerance, fPos, fNeg)
+            if debug:
+                self.log.debug("Candidate %d : BAD flux polarity %.2f < %.2f (pos=%.2f neg=%.2f)",
+                               source.getId(), fluxRatio, fluxRatioTolerance, fPos, fNeg)
             return False
 
         # 3) Not enough unmasked pixels of correct polarity
-        polarityTolerance = self.config.nPolarityRatio
+        polarityTolerance = self._nPolarityRatio
         if npolRatio < polarityTolerance:
-            self.log.debug("Candidate %d : BAD polarity count %.2f < %.2f (pos=%d neg=%d)",
-                           source.getId(), npolRatio, polarityTolerance, nPos, nNeg)
+            if debug:
+                self.log.debug("Candidate %d : BAD polarity count %.2f < %.2f (pos=%d neg=%d)",
+                               source.getId(), npolRatio, polarityTolerance, nPos, nNeg)
             return False
 
         # 4) Too many masked vs. correct polarity pixels
-        maskedTolerance = self.config.nMaskedRatio
+        maskedTolerance = self._nMaskedRatio
         if maskRatio < maskedTolerance:
-            self.log.debug("Candidate %d : BAD unmasked count %.2f < %.2f (pos=%d neg=%d mask=%d)",
-                           source.getId(), maskRatio, maskedTolerance, nPos, nNeg, nMasked)
+            if debug:
+                self.log.debug("Candidate %d : BAD unmasked count %.2f < %.2f (pos=%d neg=%d mask=%d)",
+                               source.getId(), maskRatio, maskedTolerance, nPos, nNeg, nMasked)
             return False
 
         # 5) Too few unmasked, correct polarity pixels
-        ngoodTolerance = self.config.nGoodRatio
+        ngoodTolerance = self._nGoodRatio
         if ngoodRatio < ngoodTolerance:
-            self.log.debug("Candidate %d : BAD good pixel count %.2f < %.2f (pos=%d neg=%d tot=%d)",
-                           source.getId(), ngoodRatio, ngoodTolerance, nPos, nNeg, nPixels)
+            if debug:
+                self.log.debug("Candidate %d : BAD good pixel count %.2f < %.2f (pos=%d neg=%d tot=%d)",
+                               source.getId(), ngoodRatio, ngoodTolerance, nPos, nNeg, nPixels)
             return False
 
-        self.log.debug("Candidate %d : OK flux=%.2f nPos=%d nNeg=%d nTot=%d nDetPos=%d nDetNeg=%d "
-                       "fPos=%.2f fNeg=%2f",
-                       source.getId(), flux, nPos, nNeg, nPixels, nDetPos, nDetNeg, fPos, fNeg)
+        if debug:
+            nDetPos, nDetNeg = self.countDetected(maArr)
+            self.log.debug("Candidate %d : OK flux=%.2f nPos=%d nNeg=%d nTot=%d nDetPos=%d nDetNeg=%d "
+                           "fPos=%.2f fNeg=%2f",
+                           source.getId(), flux, nPos, nNeg, nPixels, nDetPos, nDetNeg, fPos, fNeg)
         return True
+
+    def testSources(self, sources, subMis):
+        """Apply `testSource` to many candidates at once.
+
+        When every footprint has the same dimensions the images are stacked
+        and all of the tests are evaluated with single array reductions;
+        otherwise the candidates are tested one at a time.
+
+        Parameters
+        ----------
+        sources : sequence of `lsst.afw.table.SourceRecord`
+            Candidate sources.
+        subMis : sequence of `lsst.afw.image.MaskedImage`
+            Footprint of each candidate in the difference image.
+
+        Returns
+        -------
+        accepted : `numpy.ndarray` of `bool`
+            Whether each candidate passed all of the tests.
+
+        Raises
+        ------
+        ValueError
+            Raised if ``sources`` and ``subMis`` differ in length.
+        """
+        if len(sources) != len(subMis):
+            raise ValueError("Got %d sources but %d footprints" % (len(sources), len(subMis)))
+        arrays = [subMi.getArrays() for subMi in subMis]
+        if len({imArr.shape for imArr, maArr, varArr in arrays}) != 1:
+            return num.array([self.testSource(source, subMi) for source, subMi in zip(sources, subMis)],
+                             dtype=bool)
+
+        imStack = num.stack([imArr for imArr, maArr, varArr in arrays])
+        maStack = num.stack([maArr for imArr, maArr, varArr in arrays])
+        flux = num.array([source.getApFlux() for source in sources])
+        nPixels = imStack[0].size
+        axes = (1, 2)
+
+        unmasked = (maStack & self.bitMask) == 0
+        pos = unmasked & (imStack >= 0)
+        neg = unmasked & (imStack < 0)
+        nMasked = nPixels - num.count_nonzero(unmasked, axis=axes)
+        nPos = num.count_nonzero(pos, axis=axes)
+        nNeg = num.count_nonzero(neg, axis=axes)
+        fPos = num.add.reduce(imStack, axis=axes, where=pos, initial=0.0)
+        fNeg = num.abs(num.add.reduce(imStack, axis=axes, where=neg, initial=0.0))
+
+        positive = flux > 0
+        nGood = num.where(positive, nPos, nNeg)
+        nOpp = num.where(positive, nNeg, nPos)
+        fGood = num.where(positive, fPos, fNeg)
+        # Ratios that are undefined (0/0) do not reject a candidate in
+        # `testSource`, so compare with ``<`` and negate rather than ``>=``.
+        with num.errstate(divide="ignore", invalid="ignore"):
+            rejected = nMasked / nPixels > self._fBadPixels
+            rejected |= fGood / (fPos + fNeg) < self._fluxPolarityRatio
+            rejected |= nGood / (nGood + nOpp) < self._nPolarityRatio
+            rejected |= nGood / (nGood + nMasked) < self._nMaskedRatio
+            rejected |= nGood / nPixels < self._nGoodRatio
+        self.log.debug("Accepted %d of %d candidates", len(sources) - num.count_nonzero(rejected),
+                       len(sources))
+        return ~rejected
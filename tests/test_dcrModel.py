@@ -34,11 +34,18 @@ import lsst.afw.math as afwMath
 import lsst.geom as geom
 from lsst.geom import arcseconds, degrees, radians, arcminutes
 from lsst.ip.diffim.dcrModel import (DcrModel, calculateDcr, calculateImageParallacticAngle,
-                                     applyDcr, wavelengthGenerator)
+                                     applyDcr, wavelengthEdges, wavelengthGenerator,
+                                     _makeFftBinaryOpening, _smoothImage, _recursiveGaussianMinWidth)
 from lsst.obs.base import MakeRawVisitInfoViaObsInfo
 from lsst.meas.algorithms.testUtils import plantSources
 import lsst.utils.tests
 
+try:
+    import cupy
+    haveGpu = cupy.cuda.is_available()
+except ImportError:
+    haveGpu = False
+
 
 # Our calculation of hour angle and parallactic angle ignore precession
 # and nutation, so calculations depending on these are not precise. DM-20133
@@ -273,6 +280,20 @@ class DcrModelTestTask(lsst.utils.tests.TestCase):
             self.assertFloatsAlmostEqual(shiftOld[1], shiftNew[1], rtol=1e-6, atol=1e-8)
             self.assertFloatsAlmostEqual(shiftOld[0], shiftNew[0], rtol=1e-6, atol=1e-8)
 
+    def testWavelengthEdges(self):
+        """Test that the subfilter endpoints tile the band without gaps
+        and agree with the generator.
+        """
+        edges = wavelengthEdges(self.effectiveWavelength, self.bandwidth, self.dcrNumSubfilters)
+        self.assertEqual(edges.shape, (self.dcrNumSubfilters, 2))
+        self.assertFloatsAlmostEqual(edges[0, 0], self.effectiveWavelength - self.bandwidth/2)
+        self.assertFloatsAlmostEqual(edges[-1, 1], self.effectiveWavelength + self.bandwidth/2)
+        self.assertFloatsEqual(edges[1:, 0], edges[:-1, 1])
+        self.assertFloatsAlmostEqual(np.diff(edges, axis=1).ravel(), self.bandwidth/self.dcrNumSubfilters)
+        generated = list(wavelengthGenerator(self.effectiveWavelength, self.bandwidth,
+                                             self.dcrNumSubfilters))
+        self.assertFloatsEqual(np.array(generated), edges)
+
     def testCoordinateTransformDcrCalculation(self):
         """Check the DCR calculation using astropy coordinate transformations.
 
@@ -343,6 +364,69 @@ class DcrModelTestTask(lsst.utils.tests.TestCase):
                 refImage.image.array[y0 + dy, x0 + dx] = 1.
                 self.assertFloatsAlmostEqual(shiftedImage, refImage.image.array, rtol=1e-12, atol=1e-12)
 
+    def testApplyDcrSplitThreshold(self):
+        """Test that split subfilters below the threshold use the mean shift.
+        """
+        xSize, ySize = self.bbox.getDimensions()
+        image = self.rng.rand(ySize, xSize)
+        dcr = ((0.3, -0.2), (0.1, 0.4))
+        meanShift = (0.2, 0.1)
+        shiftedImage = applyDcr(image, dcr, splitSubfilters=True, splitThreshold=1.)
+        refImage = applyDcr(image, meanShift)
+        self.assertFloatsAlmostEqual(shiftedImage, refImage, rtol=1e-12, atol=1e-12)
+
+    def testBuildMatchedTemplate(self):
+        """Test that the template is the sum of the shifted subfilter models,
+        and does not depend on the number of threads.
+        """
+        modelImages = self.makeTestImages()
+        dcrModels = DcrModel(modelImages=modelImages,
+                             effectiveWavelength=self.effectiveWavelength, bandwidth=self.bandwidth)
+        visitInfo = self.makeDummyVisitInfo(30.*degrees, 50.*degrees)
+        wcs = self.makeDummyWcs(20.*degrees, 0.2*arcseconds, crval=visitInfo.getBoresightRaDec())
+        # Use an off-center sub-region, so that errors in slicing the model
+        # stack show up in the template.
+        x0, y0 = self.bbox.getBegin()
+        xSize, ySize = self.bbox.getDimensions()
+        bbox = geom.Box2I(geom.Point2I(x0 + 3, y0 + 6), geom.Extent2I(xSize - 10, ySize - 8))
+        dcrShift = calculateDcr(visitInfo, wcs, self.effectiveWavelength, self.bandwidth,
+                                self.dcrNumSubfilters, splitSubfilters=True)
+        refModel = np.mean([model[bbox].array for model in modelImages], axis=0)
+        for amplifyModel in [1., 2.]:
+            refTemplate = np.zeros_like(refModel)
+            for model, dcr in zip(modelImages, dcrShift):
+                modelArray = model[bbox].array
+                if amplifyModel > 1:
+                    modelArray = (modelArray - refModel)*amplifyModel + refModel
+                refTemplate += applyDcr(modelArray, dcr, splitSubfilters=True)
+            templates = [dcrModels.buildMatchedTemplate(visitInfo=visitInfo, bbox=bbox, wcs=wcs,
+                                                        amplifyModel=amplifyModel, numThreads=numThreads)
+                         for numThreads in [1, 3]]
+            self.assertEqual(templates[0].getBBox(), bbox)
+            self.assertFloatsEqual(templates[0].array, templates[1].array)
+            # The template is computed in single precision.
+            self.assertFloatsAlmostEqual(templates[0].array, refTemplate,
+                                         atol=1e-5*np.max(np.abs(refTemplate)))
+
+    @unittest.skipUnless(haveGpu, "cupy and a GPU are required")
+    def testBuildMatchedTemplateGpu(self):
+        """Test that the template built on a GPU matches the CPU template.
+        """
+        dcrModels = DcrModel(modelImages=self.makeTestImages(),
+                             effectiveWavelength=self.effectiveWavelength, bandwidth=self.bandwidth)
+        visitInfo = self.makeDummyVisitInfo(30.*degrees, 50.*degrees)
+        wcs = self.makeDummyWcs(20.*degrees, 0.2*arcseconds, crval=visitInfo.getBoresightRaDec())
+        bbox = geom.Box2I(self.bbox)
+        bbox.grow(-self.bufferSize)
+        for amplifyModel in [1., 2.]:
+            cpuTemplate = dcrModels.buildMatchedTemplate(visitInfo=visitInfo, bbox=bbox, wcs=wcs,
+                                                         amplifyModel=amplifyModel)
+            gpuTemplate = dcrModels.buildMatchedTemplate(visitInfo=visitInfo, bbox=bbox, wcs=wcs,
+                                                         amplifyModel=amplifyModel, useGpu=True)
+            self.assertEqual(gpuTemplate.getBBox(), bbox)
+            self.assertFloatsAlmostEqual(gpuTemplate.array, cpuTemplate.array,
+                                         atol=1e-5*np.max(np.abs(cpuTemplate.array)))
+
     def testRotationAngle(self):
         """Test that the sky rotation angle is consistently computed.
 
@@ -433,6 +517,29 @@ class DcrModelTestTask(lsst.utils.tests.TestCase):
             refModel.array[:] *= 2.
             self.assertFloatsAlmostEqual(refModel.array, newModel.array)
 
+    def testFromImageNans(self):
+        """Test that NaN pixels are zeroed and flagged when building a model.
+        """
+        xSize, ySize = self.bbox.getDimensions()
+        maskedImage = afwImage.MaskedImageF(self.bbox)
+        maskedImage.image.array[:] = self.rng.rand(ySize, xSize)
+        maskedImage.variance.array[:] = 1.
+        maskedImage.image.array[3, 5] = np.nan
+        maskedImage.variance.array[7, 2] = np.nan
+        refImage = maskedImage.image.array/self.dcrNumSubfilters
+        dcrModels = DcrModel.fromImage(maskedImage, self.dcrNumSubfilters,
+                                       effectiveWavelength=self.effectiveWavelength, bandwidth=self.bandwidth)
+        noData = dcrModels.mask.getPlaneBitMask("NO_DATA")
+        for model in dcrModels:
+            self.assertFalse(np.any(np.isnan(model.array)))
+            self.assertEqual(model.array[3, 5], 0.)
+            self.assertEqual(model.array[7, 2], 0.)
+            self.assertFloatsAlmostEqual(model.array[20:, :], refImage[20:, :])
+        self.assertFalse(np.any(np.isnan(dcrModels.variance.array)))
+        self.assertTrue(dcrModels.mask.array[3, 5] & noData)
+        self.assertTrue(dcrModels.mask.array[7, 2] & noData)
+        self.assertFalse(dcrModels.mask.array[0, 0] & noData)
+
     def testRegularizationSmallClamp(self):
         """Test that large variations between model planes are reduced.
 
@@ -524,6 +631,113 @@ class DcrModelTestTask(lsst.utils.tests.TestCase):
         lowPix = ndimage.morphology.binary_opening(lowPix, iterations=regularizationWidth)
         self.assertFalse(np.all(lowPix))
 
+    def testFftBinaryOpening(self):
+        """Test that the FFT binary opening matches `scipy.ndimage`.
+        """
+        xSize, ySize = self.bbox.getDimensions()
+        for regularizationWidth in [1, 2, 5, 8]:
+            filterStructure = ndimage.iterate_structure(ndimage.generate_binary_structure(2, 1),
+                                                        regularizationWidth)
+            binaryOpening = _makeFftBinaryOpening((ySize, xSize), filterStructure)
+            for testIter in range(self.nRandIter):
+                pixels = self.rng.rand(ySize, xSize) > 0.4
+                refPixels = ndimage.morphology.binary_opening(pixels, structure=filterStructure)
+                self.assertTrue(np.all(binaryOpening(pixels) == refPixels))
+            # Images stacked along a leading axis are opened independently.
+            pixels = self.rng.rand(2, ySize, xSize) > 0.4
+            refPixels = [ndimage.morphology.binary_opening(image, structure=filterStructure)
+                         for image in pixels]
+            self.assertTrue(np.all(binaryOpening(pixels) == refPixels))
+
+    def testApplyImageThresholdsStack(self):
+        """Test that thresholds applied to a stack match each image in turn.
+        """
+        modelImages = self.makeTestImages(fluxRange=10.)
+        dcrModels = DcrModel(modelImages=modelImages, mask=self.mask,
+                             effectiveWavelength=self.effectiveWavelength, bandwidth=self.bandwidth)
+        templateImage = dcrModels.getReferenceImage(self.bbox)
+        highThreshold = templateImage*2.
+        lowThreshold = templateImage/2.
+        for regularizationWidth in [0, 2, 5]:
+            modelStack = np.array([model.array for model in modelImages])
+            dcrModels.applyImageThresholds(modelStack, highThreshold=highThreshold,
+                                           lowThreshold=lowThreshold,
+                                           regularizationWidth=regularizationWidth)
+            for model, stackedArray in zip(modelImages, modelStack):
+                refArray = model.array.copy()
+                dcrModels.applyImageThresholds(refArray, highThreshold=highThreshold,
+                                               lowThreshold=lowThreshold,
+                                               regularizationWidth=regularizationWidth)
+                self.assertFloatsEqual(refArray, stackedArray)
+
+    def testReferenceImageSubregion(self):
+        """Test the reference image of a sub-region, and after an update.
+        """
+        dcrModels = DcrModel(modelImages=self.makeTestImages(),
+                             effectiveWavelength=self.effectiveWavelength, bandwidth=self.bandwidth)
+        bbox = geom.Box2I(self.bbox)
+        bbox.grow(-self.bufferSize)
+        refImage = np.mean([model[bbox].array for model in dcrModels], axis=0)
+        self.assertFloatsAlmostEqual(dcrModels.getReferenceImage(bbox), refImage)
+        # Updating a subfilter must be reflected in the reference image.
+        newModel = dcrModels[0].clone()
+        newModel.array += 1.
+        dcrModels[0] = newModel
+        self.assertFloatsAlmostEqual(dcrModels.getReferenceImage(bbox),
+                                     refImage + 1./self.dcrNumSubfilters, rtol=1e-6)
+
+    def testSmoothImageRecursive(self):
+        """Test that the recursive Gaussian approximates the full kernel.
+        """
+        # Large enough that the tails of the widest filter fall within the
+        # image, so that the smoothed image conserves flux.
+        size = 401
+        for sigma in [16., 24.]:
+            image = np.zeros((2, size, size), dtype=np.float32)
+            image[:, size//2, size//2] = 1.
+            smoothedImage = _smoothImage(image, sigma)
+            refImage = ndimage.gaussian_filter(image[0], sigma, mode='constant')
+            self.assertEqual(smoothedImage.dtype, image.dtype)
+            self.assertFloatsAlmostEqual(np.sum(smoothedImage[0]), 1., rtol=1e-3)
+            self.assertFloatsAlmostEqual(smoothedImage[0], smoothedImage[1])
+            self.assertFloatsAlmostEqual(smoothedImage[0], refImage, atol=0.05*np.max(refImage))
+
+    def testSmoothImageNonFinite(self):
+        """Test that a NaN pixel only affects its neighbourhood when smoothing
+        with a wide filter.
+        """
+        image = self.rng.normal(size=(2, 200, 200))
+        image[0, 50, 60] = np.nan
+        sigma = _recursiveGaussianMinWidth
+        smoothedImage = _smoothImage(image, sigma)
+        refImage = ndimage.gaussian_filter(image, (0, sigma, sigma), mode='constant')
+        nanPixels = np.isnan(smoothedImage)
+        self.assertTrue(np.all(nanPixels == np.isnan(refImage)))
+        self.assertLess(np.count_nonzero(nanPixels[0]), 0.5*nanPixels[0].size)
+        self.assertFalse(np.any(nanPixels[1]))
+        self.assertFloatsAlmostEqual(smoothedImage[~nanPixels], refImage[~nanPixels])
+
+    def testSmoothImageRecursiveEdges(self):
+        """Test that the recursive Gaussian treats pixels beyond every edge
+        of the image as zero.
+        """
+        rng = np.random.RandomState(3)
+        shape = (300, 280)
+        corners = ([0, 0, -1, -1], [0, -1, 0, -1])
+        for sigma in [16., 24.]:
+            image = np.ones(shape)
+            smoothedImage = _smoothImage(image, sigma)
+            refImage = ndimage.gaussian_filter(image, sigma, mode='constant')
+            self.assertFloatsAlmostEqual(smoothedImage, refImage, atol=0.05)
+            # Each corner of a constant image only sees a quarter of the kernel.
+            self.assertFloatsAlmostEqual(smoothedImage[corners], refImage[corners], rtol=0.05)
+            # Noise has more power at the scales where the recursive filter
+            # deviates from the Gaussian, but the edges must be no worse.
+            image = rng.normal(size=shape)
+            smoothedImage = _smoothImage(image, sigma)
+            refImage = ndimage.gaussian_filter(image, sigma, mode='constant')
+            self.assertFloatsAlmostEqual(smoothedImage, refImage, atol=0.1*np.max(np.abs(refImage)))
+
     def testIterateModel(self):
         """Test that the DcrModel is iterable, and has the right values.
         """
@@ -0,0 +1,115 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+import lsst.ip.diffim as ipDiffim
+
+
+class DiaSourceAnalystTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.config = ipDiffim.DiaSourceAnalystConfig()
+        self.analyst = ipDiffim.DiaSourceAnalyst(self.config)
+        rng = np.random.RandomState(5)
+        shape = (31, 29)
+        self.pixels = rng.normal(size=shape).astype(np.float32)
+        planes = ["DETECTED", "DETECTED_NEGATIVE", "SAT", "CR", "EDGE"]
+        bits = [afwImage.Mask.getPlaneBitMask(plane) for plane in planes]
+        self.mask = np.zeros(shape, dtype=afwImage.MaskPixel)
+        for bit in bits:
+            self.mask[rng.uniform(size=shape) < 0.1] |= bit
+
+    def testAnalyze(self):
+        """The fused pixel statistics should match countPolarity.
+        """
+        nPos, nNeg, fPos, fNeg = self.analyst.countPolarity(self.mask, self.pixels)
+        nMasked = self.analyst.countMasked(self.mask)
+        unmasked = (self.mask & self.analyst.bitMask) == 0
+        result = self.analyst._analyze(self.pixels, unmasked)
+        self.assertEqual(result[0], nPos)
+        self.assertEqual(result[1], nNeg)
+        self.assertFloatsAlmostEqual(result[2], fPos, rtol=1e-5)
+        self.assertFloatsAlmostEqual(result[3], fNeg, rtol=1e-5)
+        self.assertEqual(np.count_nonzero(~unmasked), nMasked)
+        self.assertEqual(nPos + nNeg + nMasked, self.mask.size)
+
+    def testTestSources(self):
+        """The batched tests should agree with testing one source at a time,
+        for both equal and mixed footprint sizes.
+        """
+        rng = np.random.RandomState(11)
+        sources = []
+        subMis = []
+        for i in range(20):
+            subMi = afwImage.MaskedImageF(9, 7)
+            sign = 1 if i % 2 else -1
+            subMi.image.array[:] = rng.normal(size=subMi.image.array.shape) + sign*rng.uniform(0, 3)
+            subMi.mask.array[rng.uniform(size=subMi.mask.array.shape) < 0.1] |= \
+                afwImage.Mask.getPlaneBitMask("SAT")
+            sources.append(_Source(i, float(np.sum(subMi.image.array))))
+            subMis.append(subMi)
+        expected = [self.analyst.testSource(source, subMi) for source, subMi in zip(sources, subMis)]
+        accepted = self.analyst.testSources(sources, subMis)
+        self.assertEqual(accepted.dtype, bool)
+        self.assertEqual(list(accepted), expected)
+        self.assertTrue(0 < np.count_nonzero(accepted) < len(sources))
+
+        bbox = geom.Box2I(geom.Point2I(1, 1), geom.Extent2I(4, 4))
+        subMis[0] = afwImage.MaskedImageF(subMis[0], bbox, origin=afwImage.LOCAL)
+        expected[0] = self.analyst.testSource(sources[0], subMis[0])
+        self.assertEqual(list(self.analyst.testSources(sources, subMis)), expected)
+
+        with self.assertRaises(ValueError):
+            self.analyst.testSources(sources[1:], subMis)
+
+
+class _Source:
+    """Minimal stand-in for a SourceRecord as used by DiaSourceAnalyst.
+    """
+
+    def __init__(self, sourceId, apFlux):
+        self.sourceId = sourceId
+        self.apFlux = apFlux
+
+    def getId(self):
+        return self.sourceId
+
+    def getApFlux(self):
+        return self.apFlux
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()